@@ -1,12 +1,181 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file, request, make_response 
+from flask import Flask, abort, current_app, send_from_directory, request, make_response 
+import math
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
-from sqlalchemy.exc import OperationalError
+import orjson
+from decimal import Decimal
+from functools import lru_cache
+from jinja2 import Environment
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+from werkzeug.routing import BaseConverter, ValidationError
+
+# SQL statements are built once at import time and reused across requests
+
+# 找出有 term_a 但沒有 term_b 的研究（連同 metadata 標題一次取回）
+# ILIKE '%term%' is served by the pg_trgm GIN index idx_annotations_terms_term_trgm;
+# substring matching is kept because URL underscores act as LIKE wildcards for spaces
+_Q_DISSOC_TERMS = text("""
+    SELECT COALESCE(
+        json_agg(json_build_object('study_id', s.study_id, 'title', s.title)),
+        '[]'::json
+    )
+    FROM (
+        SELECT DISTINCT m.study_id, m.title
+        FROM ns.annotations_terms AS a
+        JOIN ns.metadata AS m ON m.study_id = a.study_id
+        WHERE a.term ILIKE :term_a
+          AND NOT EXISTS (
+              SELECT 1 FROM ns.annotations_terms AS b
+              WHERE b.study_id = a.study_id AND b.term ILIKE :term_b
+          )
+        LIMIT 50
+    ) AS s;
+""")
+
+# A − B and B − A in one statement: both point lookups, the metadata titles
+# and the final JSON arrays are resolved server-side in a single round-trip.
+# Both points are matched in one scan of ns.coordinates against the stored
+# x/y/z columns (OR-ed quals, so the planner can BitmapOr two probes of the
+# btree idx_coordinates_xyz) and each study is tagged in_a/in_b.
+_Q_DISSOC_LOCATIONS = text("""
+    WITH tagged AS (
+        SELECT study_id,
+               bool_or(x = :x1 AND y = :y1 AND z = :z1) AS in_a,
+               bool_or(x = :x2 AND y = :y2 AND z = :z2) AS in_b
+        FROM ns.coordinates
+        WHERE (x = :x1 AND y = :y1 AND z = :z1)
+           OR (x = :x2 AND y = :y2 AND z = :z2)
+        GROUP BY study_id
+    ),
+    hits AS (
+        SELECT m.study_id, m.title, t.in_a, t.in_b
+        FROM tagged AS t
+        JOIN ns.metadata AS m ON m.study_id = t.study_id
+        WHERE t.in_a <> t.in_b
+    )
+    SELECT json_build_object(
+        'A_minus_B', COALESCE(
+            json_agg(json_build_object('study_id', study_id, 'title', title))
+                FILTER (WHERE in_a AND NOT in_b),
+            '[]'::json
+        ),
+        'B_minus_A', COALESCE(
+            json_agg(json_build_object('study_id', study_id, 'title', title))
+                FILTER (WHERE in_b AND NOT in_a),
+            '[]'::json
+        )
+    )
+    FROM hits;
+""")
+
+# /test_db probes: version, counts and samples folded into one JSON document.
+# Counts default to the planner's pg_class.reltuples estimate (O(1), no heap
+# scan); /test_db?exact=1 swaps in real COUNT(*)s.
+_COUNT_ESTIMATE = "(SELECT reltuples::bigint FROM pg_class WHERE oid = 'ns.{table}'::regclass)"
+_COUNT_EXACT = "(SELECT COUNT(*) FROM ns.{table})"
+
+_TEST_DB_SAMPLES = {
+    "coordinates_sample":
+        "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3",
+    "metadata_sample": "SELECT * FROM ns.metadata LIMIT 3",
+    "annotations_terms_sample":
+        "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3",
+}
+
+def _sample_json(sql):
+    return f"COALESCE((SELECT json_agg(row_to_json(s)) FROM ({sql}) AS s), '[]'::json)"
+
+def _test_db_query(count_sql, with_samples=True):
+    fields = [
+        "'version', version()",
+        *(f"'{t}_count', {count_sql.format(table=t)}"
+          for t in ("coordinates", "metadata", "annotations_terms")),
+    ]
+    if with_samples:
+        fields += [f"'{key}', {_sample_json(sql)}" for key, sql in _TEST_DB_SAMPLES.items()]
+    return text("SELECT json_build_object(" + ", ".join(fields) + ") AS j;")
+
+_Q_TEST_DB = _test_db_query(_COUNT_ESTIMATE)
+_Q_TEST_DB_EXACT = _test_db_query(_COUNT_EXACT)
+
+# Fallback when the combined probe fails (e.g. a table's columns are off):
+# version/counts alone, then each sample on its own so one bad table yields []
+_Q_TEST_DB_HEAD = _test_db_query(_COUNT_ESTIMATE, with_samples=False)
+_Q_TEST_DB_HEAD_EXACT = _test_db_query(_COUNT_EXACT, with_samples=False)
+_Q_TEST_DB_SAMPLES = {key: text(f"SELECT {_sample_json(sql)};") for key, sql in _TEST_DB_SAMPLES.items()}
+
+# HTML views are compiled once at import time; autoescape keeps DB titles from injecting markup
+_jinja = Environment(autoescape=True)
+
+_HTML_STYLE = """
+        <style>
+            body { font-family: system-ui, sans-serif; margin: 40px; }
+            h2 { font-size: 1.5em; margin-bottom: 0.5em; }
+            table { border-collapse: collapse; width: 80%; margin-top: 1em; }
+            th, td { border: 1px solid #ccc; padding: 8px 12px; text-align: left; }
+            th { background-color: #f3f4f6; }
+            tr:nth-child(even) { background-color: #fafafa; }
+            .count { font-weight: bold; color: #2563eb; }
+        </style>
+"""
+
+_TMPL_TERMS = _jinja.from_string("""
+<html>
+    <head>
+        <meta charset="utf-8">
+        <title>Dissociate by Terms</title>""" + _HTML_STYLE + """    </head>
+    <body>
+        <h2>🧠 Dissociate by Terms</h2>
+        <p>Studies mentioning <b>{{ term_a }}</b> but not <b>{{ term_b }}</b></p>
+        <p class="count">Count: {{ data.count }}</p>
+
+        <table>
+            <tr><th>Study ID</th><th>Title</th></tr>
+            {% for s in data.studies %}<tr><td>{{ s.study_id }}</td><td>{{ s.title or "(no title)" }}</td></tr>{% endfor %}
+        </table>
+    </body>
+</html>
+""")
+
+_TMPL_LOCATIONS = _jinja.from_string("""
+<html>
+    <head>
+        <meta charset="utf-8">
+        <title>Dissociate by Coordinates</title>""" + _HTML_STYLE + """    </head>
+    <body>
+        <h2>📍 Dissociate by Coordinates</h2>
+        <p>Comparing <b>{{ coords_a }}</b> vs <b>{{ coords_b }}</b></p>
+
+        <h3>A − B Studies that mention {{ coords_a }} but not {{ coords_b }}.</h3>
+        <table>
+            <tr><th>Study ID</th><th>Title</th></tr>
+            {% for s in data.A_minus_B %}<tr><td>{{ s.study_id }}</td><td>{{ s.title or "(no title)" }}</td></tr>{% endfor %}
+        </table>
+
+        <h3>B − A Studies that mention {{ coords_b }} but not {{ coords_a }}.</h3>
+        <table>
+            <tr><th>Study ID</th><th>Title</th></tr>
+            {% for s in data.B_minus_A %}<tr><td>{{ s.study_id }}</td><td>{{ s.title or "(no title)" }}</td></tr>{% endfor %}
+        </table>
+    </body>
+</html>
+""")
 
 _engine = None
 
+def _set_search_path(dbapi_conn, connection_record):
+    """Set search_path once per new DBAPI connection, so requests no longer spend a
+    round-trip on SET search_path. Runs in autocommit so the pool's reset rollback
+    cannot undo it; any ?options=... in DB_URL is left untouched."""
+    autocommit = dbapi_conn.autocommit
+    dbapi_conn.autocommit = True
+    cur = dbapi_conn.cursor()
+    cur.execute("SET SESSION search_path TO ns, public")
+    cur.close()
+    dbapi_conn.autocommit = autocommit
+
 def get_engine():
     global _engine
     if _engine is not None:
@@ -17,14 +186,92 @@ def get_engine():
     # Normalize old 'postgres://' scheme to 'postgresql://'
     if db_url.startswith("postgres://"):
         db_url = "postgresql://" + db_url[len("postgres://"):]
+    connect_args = {}
+    # psycopg (v3) PREPAREs a statement server-side after it has run
+    # prepare_threshold times on a connection, so the stable-shaped dissociate
+    # queries stop being re-planned; psycopg2 has no equivalent
+    if make_url(db_url).get_driver_name() == "psycopg":
+        connect_args["prepare_threshold"] = int(os.getenv("DB_PREPARE_THRESHOLD", "3"))
+    # Explicit pool sizing: the QueuePool default (5 + 10 overflow) saturates under
+    # a few concurrent requests. LIFO keeps recently used connections warm, and
+    # recycling ahead of typical server idle timeouts keeps pre-ping failures rare.
     _engine = create_engine(
         db_url,
         pool_pre_ping=True,
+        pool_size=20,
+        max_overflow=40,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        connect_args=connect_args,
     )
+    event.listen(_engine, "connect", _set_search_path, insert=True)
     return _engine
 
+def _format_coord(coords):
+    """`x_y_z` text for a coordinate tuple, as written in the URL (plain decimals, no exponent)."""
+    coords = tuple(map(float, coords))
+    if not all(map(math.isfinite, coords)):
+        raise ValueError(f"Coordinates must be finite: {coords!r}")
+    return "_".join(
+        str(int(v)) if v.is_integer() else format(Decimal(repr(v)), "f")
+        for v in coords
+    )
+
+class CoordConverter(BaseConverter):
+    """URL converter for `x_y_z` MNI coordinates; matched and parsed at routing time."""
+    regex = r"-?\d+(?:\.\d+)?_-?\d+(?:\.\d+)?_-?\d+(?:\.\d+)?"
+
+    def to_python(self, value):
+        coords = tuple(float(v) for v in value.split("_"))
+        # Overlong digit strings overflow to inf; treat them as a non-matching URL (404)
+        if not all(map(math.isfinite, coords)):
+            raise ValidationError()
+        return coords
+
+    def to_url(self, value):
+        return _format_coord(value)
+
+def _json_response(obj, status=200):
+    """JSON response encoded with orjson (C) instead of Flask's stdlib-json jsonify."""
+    return current_app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
+def _dissociate_response(template, data, **context):
+    """HTML / JSON 自動切換: render `template` for browsers, JSON otherwise."""
+    if request.accept_mimetypes.accept_html:
+        return make_response(template.render(data=data, **context), 200)
+    return _json_response(data, 200)
+
+@lru_cache(maxsize=1024)
+def _dissociate_terms_payload(term_a, term_b):
+    """Cached DB lookup for /dissociate/terms; expects already-normalized terms."""
+    eng = get_engine()
+    with eng.begin() as conn:
+        # The driver decodes the json_agg scalar straight into a list of dicts
+        studies = conn.execute(_Q_DISSOC_TERMS, {"term_a": f"%{term_a}%", "term_b": f"%{term_b}%"}).scalar()
+        return {"term_a": term_a, "term_b": term_b, "count": len(studies), "studies": studies}
+
+
+@lru_cache(maxsize=1024)
+def _dissociate_locations_payload(x1, y1, z1, x2, y2, z2):
+    """Cached DB lookup for /dissociate/locations."""
+    eng = get_engine()
+    with eng.begin() as conn:
+        dissoc = conn.execute(_Q_DISSOC_LOCATIONS, {
+            "x1": x1, "y1": y1, "z1": z1,
+            "x2": x2, "y2": y2, "z2": z2,
+        }).scalar()
+
+    return {
+        "coords_a": [x1, y1, z1],
+        "coords_b": [x2, y2, z2],
+        "A_minus_B": dissoc["A_minus_B"],
+        "B_minus_A": dissoc["B_minus_A"]
+    }
+
+
 def create_app():
     app = Flask(__name__)
+    app.url_map.converters["coord"] = CoordConverter
 
     @app.get("/", endpoint="health")
     def health():
@@ -32,232 +279,77 @@ def create_app():
 
     @app.get("/img", endpoint="show_img")
     def show_img():
-        return send_file("amygdala.gif", mimetype="image/gif")
+        # Long-lived Cache-Control plus ETag/Last-Modified so repeat clients get 304s
+        return send_from_directory(app.root_path, "amygdala.gif", mimetype="image/gif",
+                                   max_age=86400, conditional=True)
 
     @app.get("/terms/<term>/studies", endpoint="terms_studies")
     def get_studies_by_term(term):
         return term
 
-    @app.get("/locations/<coords>/studies", endpoint="locations_studies")
+    @app.get("/locations/<coord:coords>/studies", endpoint="locations_studies")
     def get_studies_by_coordinates(coords):
-        x, y, z = map(int, coords.split("_"))
-        return jsonify([x, y, z])
+        return _json_response(list(coords))
 
     @app.get("/test_db", endpoint="test_db")
     
     def test_db():
         eng = get_engine()
-        payload = {"ok": False, "dialect": eng.dialect.name}
+        exact = request.args.get("exact") == "1"
+        payload = {"ok": False, "dialect": eng.dialect.name, "counts_exact": exact}
 
         try:
-            with eng.begin() as conn:
-                # Ensure we are in the correct schema
-                conn.execute(text("SET search_path TO ns, public;"))
-                payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
-
-                # Counts
-                payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
-                payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
-                payload["annotations_terms_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.annotations_terms")).scalar()
-
-                # Samples
-                try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
-                    )).mappings().all()
-                    payload["coordinates_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["coordinates_sample"] = []
-
-                try:
-                    # Select a few columns if they exist; otherwise select a generic subset
-                    rows = conn.execute(text("SELECT * FROM ns.metadata LIMIT 3")).mappings().all()
-                    payload["metadata_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["metadata_sample"] = []
-
-                try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
-                    )).mappings().all()
-                    payload["annotations_terms_sample"] = [dict(r) for r in rows]
-                except Exception:
-                    payload["annotations_terms_sample"] = []
+            try:
+                # Version, counts and samples in one round-trip
+                with eng.begin() as conn:
+                    payload.update(conn.execute(_Q_TEST_DB_EXACT if exact else _Q_TEST_DB).scalar())
+            except OperationalError:
+                # Connection failures/timeouts: no retry, report the original error
+                raise
+            except DBAPIError:
+                # A statement error (e.g. a sample table's columns are off): retry in a
+                # fresh transaction with each sample isolated by a savepoint
+                with eng.begin() as conn:
+                    payload.update(conn.execute(_Q_TEST_DB_HEAD_EXACT if exact else _Q_TEST_DB_HEAD).scalar())
+                    for key, query in _Q_TEST_DB_SAMPLES.items():
+                        try:
+                            with conn.begin_nested():
+                                payload[key] = conn.execute(query).scalar()
+                        except OperationalError:
+                            raise
+                        except DBAPIError:
+                            payload[key] = []
 
             payload["ok"] = True
-            return jsonify(payload), 200
+            return _json_response(payload, 200)
 
         except Exception as e:
             payload["error"] = str(e)
-            return jsonify(payload), 500
+            return _json_response(payload, 500)
     
     @app.get("/dissociate/terms/<term_a>/<term_b>", endpoint="dissociate_terms")
     def dissociate_terms(term_a, term_b):
-        eng = get_engine()
+        term_a, term_b = term_a.lower(), term_b.lower()
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-
-                # 找出有 term_a 但沒有 term_b 的研究
-                query = text("""
-                    SELECT DISTINCT a.study_id
-                    FROM ns.annotations_terms AS a
-                    WHERE a.term ILIKE :term_a
-                    AND a.study_id NOT IN (
-                        SELECT study_id FROM ns.annotations_terms WHERE term ILIKE :term_b
-                    )
-                    LIMIT 50;
-                """)
-
-                results = conn.execute(query, {"term_a": f"%{term_a}%", "term_b": f"%{term_b}%"}).fetchall()
-                study_ids = [r[0] for r in results]
-
-                if not study_ids:
-                    data = {"term_a": term_a, "term_b": term_b, "count": 0, "studies": []}
-                else:
-                    meta_query = text("""
-                        SELECT study_id, title
-                        FROM ns.metadata
-                        WHERE study_id = ANY(:ids)
-                        LIMIT 50;
-                    """)
-                    meta_results = conn.execute(meta_query, {"ids": study_ids}).mappings().all()
-                    studies = [dict(r) for r in meta_results]
-                    data = {"term_a": term_a, "term_b": term_b, "count": len(studies), "studies": studies}
-
-                #  HTML / JSON 自動切換
-                if request.accept_mimetypes.accept_html:
-                    html = f"""
-                    <html>
-                    <head>
-                        <meta charset="utf-8">
-                        <title>Dissociate by Terms</title>
-                        <style>
-                            body {{ font-family: system-ui, sans-serif; margin: 40px; }}
-                            h2 {{ font-size: 1.5em; margin-bottom: 0.5em; }}
-                            table {{ border-collapse: collapse; width: 80%; margin-top: 1em; }}
-                            th, td {{ border: 1px solid #ccc; padding: 8px 12px; text-align: left; }}
-                            th {{ background-color: #f3f4f6; }}
-                            tr:nth-child(even) {{ background-color: #fafafa; }}
-                            .count {{ font-weight: bold; color: #2563eb; }}
-                        </style>
-                    </head>
-                    <body>
-                        <h2>🧠 Dissociate by Terms</h2>
-                        <p>Studies mentioning <b>{term_a}</b> but not <b>{term_b}</b></p>
-                        <p class="count">Count: {data['count']}</p>
-
-                        <table>
-                            <tr><th>Study ID</th><th>Title</th></tr>
-                            {''.join(f"<tr><td>{s['study_id']}</td><td>{s.get('title','(no title)')}</td></tr>" for s in data['studies'])}
-                        </table>
-                    </body>
-                    </html>
-                    """
-                    return make_response(html, 200)
-                else:
-                    return jsonify(data), 200
+            data = _dissociate_terms_payload(term_a, term_b)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
-        
+            return _json_response({"error": str(e)}, 500)
+
+        return _dissociate_response(_TMPL_TERMS, data, term_a=term_a, term_b=term_b)
+
     # 🧠 Dissociate by coordinates endpoint
     
-    @app.get("/dissociate/locations/<coords_a>/<coords_b>", endpoint="dissociate_locations")
+    # Malformed coordinates never reach the handler: CoordConverter rejects them with a 404
+    @app.get("/dissociate/locations/<coord:coords_a>/<coord:coords_b>", endpoint="dissociate_locations")
     def dissociate_locations(coords_a, coords_b):
+        (x1, y1, z1), (x2, y2, z2) = coords_a, coords_b
         try:
-            x1, y1, z1 = map(float, coords_a.split("_"))
-            x2, y2, z2 = map(float, coords_b.split("_"))
-        except ValueError:
-            return jsonify({"error": "Invalid coordinate format. Use x_y_z with underscores."}), 400
-
-        eng = get_engine()
-        try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-
-                # Helper: find studies containing a coordinate point (using ST_Equals for exact match)
-                def get_studies(x, y, z):
-                    query = text("""
-                        SELECT DISTINCT study_id
-                        FROM ns.coordinates
-                        WHERE ST_X(geom) = :x
-                          AND ST_Y(geom) = :y
-                          AND ST_Z(geom) = :z
-                        LIMIT 100;
-                    """)
-                    results = conn.execute(query, {"x": x, "y": y, "z": z}).fetchall()
-                    return [r[0] for r in results]
-
-                studies_a = set(get_studies(x1, y1, z1))
-                studies_b = set(get_studies(x2, y2, z2))
-
-                dissoc_a_b = list(studies_a - studies_b)
-                dissoc_b_a = list(studies_b - studies_a)
-
-                # Optional: fetch titles from metadata
-                if dissoc_a_b or dissoc_b_a:
-                    all_ids = list(set(dissoc_a_b) | set(dissoc_b_a))  # <-- 修正這裡
-                    meta_query = text("""
-                        SELECT study_id, title
-                        FROM ns.metadata
-                        WHERE study_id = ANY(:ids)
-                    """)
-                    meta_results = conn.execute(meta_query, {"ids": all_ids}).mappings().all()
-                    meta_dict = {r["study_id"]: r["title"] for r in meta_results}
-                else:
-                    meta_dict = {}
-
-
-            data = {
-                "coords_a": [x1, y1, z1],
-                "coords_b": [x2, y2, z2],
-                "A_minus_B": [{"study_id": sid, "title": meta_dict.get(sid)} for sid in dissoc_a_b],
-                "B_minus_A": [{"study_id": sid, "title": meta_dict.get(sid)} for sid in dissoc_b_a]
-            }
-
-            #  HTML / JSON 自動切換
-            if request.accept_mimetypes.accept_html:
-                html = f"""
-                <html>
-                <head>
-                    <meta charset="utf-8">
-                    <title>Dissociate by Coordinates</title>
-                    <style>
-                        body {{ font-family: system-ui, sans-serif; margin: 40px; }}
-                        h2 {{ font-size: 1.5em; margin-bottom: 0.5em; }}
-                        table {{ border-collapse: collapse; width: 80%; margin-top: 1em; }}
-                        th, td {{ border: 1px solid #ccc; padding: 8px 12px; text-align: left; }}
-                        th {{ background-color: #f3f4f6; }}
-                        tr:nth-child(even) {{ background-color: #fafafa; }}
-                        .count {{ font-weight: bold; color: #2563eb; }}
-                    </style>
-                </head>
-                <body>
-                    <h2>📍 Dissociate by Coordinates</h2>
-                    <p>Comparing <b>{coords_a}</b> vs <b>{coords_b}</b></p>
-
-                    <h3>A − B Studies that mention {coords_a} but not {coords_b}.</h3>
-                    <table>
-                        <tr><th>Study ID</th><th>Title</th></tr>
-                        {''.join(f"<tr><td>{s['study_id']}</td><td>{s.get('title','(no title)')}</td></tr>" for s in data['A_minus_B'])}
-                    </table>
-
-                    <h3>B − A Studies that mention {coords_b} but not {coords_a}.</h3>
-                    <table>
-                        <tr><th>Study ID</th><th>Title</th></tr>
-                        {''.join(f"<tr><td>{s['study_id']}</td><td>{s.get('title','(no title)')}</td></tr>" for s in data['B_minus_A'])}
-                    </table>
-                </body>
-                </html>
-                """
-                return make_response(html, 200)
-            else:
-                return jsonify(data), 200
-
-
+            data = _dissociate_locations_payload(x1, y1, z1, x2, y2, z2)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return _json_response({"error": str(e)}, 500)
 
+        return _dissociate_response(_TMPL_LOCATIONS, data,
+                                    coords_a=_format_coord(coords_a), coords_b=_format_coord(coords_b))
 
     return app
 # WSGI entry point (no __main__)
@@ -36,6 +36,8 @@ def parse_args():
     ap.add_argument("--stage-chunksize", type=int, default=50000, help="pandas.to_sql() chunksize for staging loads")
     ap.add_argument("--enable-json", action="store_true", help="Also build annotations_json (slow)")
     ap.add_argument("--srid", type=int, default=4326, help="SRID for geometry(POINTZ). Default 4326")
+    ap.add_argument("--migrate-only", action="store_true",
+                    help="Upgrade an existing database in place (add stored x/y/z + btree to coordinates) and exit; no Parquet reload")
     return ap.parse_args()
 
 
@@ -69,6 +71,33 @@ def is_finite_series(s: pd.Series) -> pd.Series:
 # -----------------------------
 # Coordinates (POINTZ + GIST)
 # -----------------------------
+def add_coordinates_xyz(conn, schema: str):
+    # Stored x/y/z mirrors of geom: exact-point lookups become a btree probe
+    conn.execute(text(f"""
+        ALTER TABLE {schema}.coordinates
+            ADD COLUMN IF NOT EXISTS x DOUBLE PRECISION GENERATED ALWAYS AS (ST_X(geom)) STORED,
+            ADD COLUMN IF NOT EXISTS y DOUBLE PRECISION GENERATED ALWAYS AS (ST_Y(geom)) STORED,
+            ADD COLUMN IF NOT EXISTS z DOUBLE PRECISION GENERATED ALWAYS AS (ST_Z(geom)) STORED;
+    """))
+
+
+def index_coordinates_xyz(conn, schema: str):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_xyz ON {schema}.coordinates (x, y, z);"))
+
+
+def migrate_coordinates_xyz(engine: Engine, schema: str):
+    """
+    Upgrade an already-loaded coordinates table in place (idempotent, no reload):
+    add the stored x/y/z columns and their btree index used by the API.
+    """
+    print("→ coordinates: adding stored x/y/z + btree in place")
+    with engine.begin() as conn:
+        add_coordinates_xyz(conn, schema)
+        index_coordinates_xyz(conn, schema)
+        conn.execute(text(f"ANALYZE {schema}.coordinates;"))
+    print("→ coordinates migration done.")
+
+
 def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize: int, if_exists: str, srid: int):
     print("→ coordinates: preparing dataframe")
     must_have = ["study_id", "x", "y", "z"]
@@ -109,6 +138,7 @@ def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize:
                 geom geometry(POINTZ, {srid}) NOT NULL
             );
         """))
+        add_coordinates_xyz(conn, schema)
         if if_exists == "replace":
             conn.execute(text(f"TRUNCATE TABLE {schema}.coordinates;"))
         print("→ coordinates: populating geometry from staging")
@@ -121,9 +151,10 @@ def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize:
         print("→ coordinates: indexing & analyze")
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_study ON {schema}.coordinates (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_gist ON {schema}.coordinates USING GIST (geom);"))
+        index_coordinates_xyz(conn, schema)
         conn.execute(text(f"ANALYZE {schema}.coordinates;"))
         conn.execute(text(f"DROP TABLE IF EXISTS {schema}.coordinates_stage;"))
-    print("→ coordinates (POINTZ + GIST) done.")
+    print("→ coordinates (POINTZ + GIST + xyz btree) done.")
 
 
 # -----------------------------
@@ -261,6 +292,8 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term ON {schema}.annotations_terms (term);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_study ON {schema}.annotations_terms (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_study ON {schema}.annotations_terms (term, study_id);"))
+        # Trigram GIN so the API's ILIKE '%term%' lookups can use an index
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON {schema}.annotations_terms USING GIN (term gin_trgm_ops);"))
         conn.execute(text(f"ANALYZE {schema}.annotations_terms;"))
         # Build PK/unique AFTER load to avoid per-row maintenance
         conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_annotations_terms ON {schema}.annotations_terms (study_id, contrast_id, term);"))
@@ -306,6 +339,11 @@ def main():
     print("✅ current_database:", db[0])
     print("✅ current_schema:", sch[0])
 
+    if args.migrate_only:
+        print("\n=== Migrate: coordinates ===")
+        migrate_coordinates_xyz(engine, args.schema)
+        return
+
     # Load Parquet files
     print("📦 loading Parquet files...")
     coords = load_parquet(os.path.join(args.data_dir, "coordinates.parquet"))
@@ -324,7 +362,7 @@ def main():
     build_annotations(engine, ann, args.schema, args.batch_cols, enable_json=args.enable_json)
 
     print("\n=== Ready ===")
-    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
+    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST, stored x/y/z + btree)")
     print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
     print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
 